@@ -3,31 +3,129 @@ import io
 import tokenize
 from argparse import ArgumentParser
 
-from typing import Optional, List, Iterator
+from typing import Optional, List, Iterable, Iterator, Tuple
 from collections import namedtuple
 from pprint import pprint
 
 Comment = namedtuple("Comment", ["lineno", "text"])
+Binding = namedtuple("Binding", ["comment", "node"])
 
 
-def get_comments(source: str) -> Iterator[Comment]:
+def _comment_tokens(source: str) -> Iterator[Tuple[Comment, bool]]:
+    # Yields each comment along with whether code precedes it on its line.
     buffer = io.StringIO(source)
     for token in tokenize.generate_tokens(buffer.readline):
         if token.type == tokenize.COMMENT:
             assert token.start[0] == token.end[0]
-            yield Comment(token.start[0], token.string)
+            trailing = bool(token.line[: token.start[1]].strip())
+            yield Comment(token.start[0], token.string), trailing
+
+
+def get_comments(source: str) -> Iterator[Comment]:
+    for comment, _ in _comment_tokens(source):
+        yield comment
+
+
+def iter_statements(tree: ast.AST) -> Iterator[ast.stmt]:
+    """Yield every statement in pre-order, which is source order."""
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.stmt):
+            yield node
+        stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+
+def start_line(node: ast.stmt) -> int:
+    # A decorated definition starts at its first decorator, not at the
+    # `def`/`class` line that node.lineno points to.
+    decorators = getattr(node, "decorator_list", None)
+    if decorators:
+        return min(node.lineno, *(d.lineno for d in decorators))
+    return node.lineno
+
+
+def bind_comments(
+    source: str, tree: Optional[ast.AST] = None
+) -> Iterator[Binding]:
+    """Attach each comment to a statement. A comment following code on
+    its line binds to the statement starting on that line, or else to
+    the innermost statement spanning it (e.g. inside a multi-line call or
+    signature). A comment on a line of its own binds to the next
+    statement if that starts before the innermost spanning statement
+    ends (a leading comment), or else to the spanning statement (e.g.
+    after the last statement of a block).
+
+    Statements form a line-sorted index which is swept once alongside
+    the (already sorted) comments, keeping a stack of the statements
+    that are still open, so the whole binding is linear in the size of
+    the file; no tree is walked per comment. node is None for comments
+    after the last statement of a module."""
+    if tree is None:
+        tree = ast.parse(source)
+
+    # Pre-order is sorted already, so this sort is a linear check.
+    statements = sorted(
+        ((start_line(node), node) for node in iter_statements(tree)),
+        key=lambda item: item[0],
+    )
+    index, enclosing = 0, []
+    for comment, trailing in _comment_tokens(source):
+        lineno = comment.lineno
+        while index < len(statements) and statements[index][0] < lineno:
+            start, node = statements[index]
+            while enclosing and enclosing[-1].end_lineno < start:
+                enclosing.pop()
+            enclosing.append(node)
+            index += 1
+        while enclosing and enclosing[-1].end_lineno < lineno:
+            enclosing.pop()
+
+        start, following = (
+            statements[index] if index < len(statements) else (None, None)
+        )
+        if following is not None and (
+            start == lineno
+            or not trailing
+            and (not enclosing or start <= enclosing[-1].end_lineno)
+        ):
+            yield Binding(comment, following)
+        else:
+            yield Binding(comment, enclosing[-1] if enclosing else None)
+
+
+def bind_files(
+    files: Iterable[str],
+) -> Iterator[Tuple[str, List[Binding]]]:
+    """Bind comments for a stream of files, one file in memory at a time.
+    Files that can't be decoded or parsed are skipped."""
+    for file in files:
+        try:
+            with tokenize.open(file) as stream:
+                source = stream.read()
+            bindings = list(bind_comments(source))
+        except (OSError, SyntaxError, ValueError, tokenize.TokenError):
+            continue
+        yield file, bindings
 
 
 def main(argv: Optional[List[str]] = None) -> None:
     parser = ArgumentParser()
-    parser.add_argument("file")
+    parser.add_argument("files", nargs="+")
 
     options = parser.parse_args(argv)
-    with tokenize.open(options.file) as stream:
-        source = stream.read()
-
-    print("Comments: ")
-    pprint(list(get_comments(source)))
+    for file, bindings in bind_files(options.files):
+        print(f"{file}:")
+        pprint(
+            [
+                (
+                    comment,
+                    node
+                    and f"{type(node).__name__} at line {node.lineno}",
+                )
+                for comment, node in bindings
+            ]
+        )
 
 
 if __name__ == "__main__":
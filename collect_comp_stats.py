@@ -1,10 +1,25 @@
 import ast
-import tokenize
-import traceback
-import warnings
+import json
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from array import array
 from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from pprint import pprint
+
+from corpus import (
+    CounterAnalysis,
+    ResultCache,
+    chunked,
+    imap_unordered,
+    iter_files,
+    parse_source,
+    register,
+    scan,
+)
 
 MODULES = """\
 __future__
@@ -907,37 +922,356 @@ def change_context(func):
     return inner
 
 
-def process_package(directory):
+def count_module_calls_walk(source, tree):
+    # Reference implementation, kept for benchmark().
     number = Counter()
-    for file in directory.glob("**/*.py"):
-        try:
-            with tokenize.open(file) as stream:
-                tree = ast.parse(stream.read())
-        except:
-            continue
-        for call in filter(
-            lambda node: isinstance(node, ast.Call), ast.walk(tree)
+    for call in filter(
+        lambda node: isinstance(node, ast.Call), ast.walk(tree)
+    ):
+        if (
+            type(call.func) is ast.Attribute
+            and type(call.func.value) is ast.Name
+            and call.func.value.id in MODULES
         ):
+            number[call.func.value.id + "." + call.func.attr] += 1
+    return number
+
+
+# Nodes that can never contain a call; the matcher doesn't descend into
+# them. Expression contexts alone are a large share of all nodes.
+_LEAVES = frozenset(
+    leaf
+    for base in (
+        ast.expr_context,
+        ast.operator,
+        ast.unaryop,
+        ast.cmpop,
+        ast.boolop,
+        ast.Constant,
+        ast.Name,
+        ast.alias,
+        ast.Import,
+        ast.ImportFrom,
+        ast.Global,
+        ast.Nonlocal,
+        ast.Pass,
+        ast.Break,
+        ast.Continue,
+    )
+    for leaf in (base, *base.__subclasses__())
+)
+
+# module -> attr -> interned "module.attr" key. Both halves are plain
+# identifiers, so the key splits back unambiguously on the first dot.
+_KEYS = defaultdict(dict)
+
+
+def _call_key(module, attr):
+    attrs = _KEYS[module]
+    if (key := attrs.get(attr)) is None:
+        key = attrs[attr] = sys.intern(f"{module}.{attr}")
+    return key
+
+
+def count_module_calls(source, tree):
+    hits = defaultdict(int)
+    stack = [tree]
+    pop, push = stack.pop, stack.append
+    Call, Attribute, Name, AST = ast.Call, ast.Attribute, ast.Name, ast.AST
+    leaves = _LEAVES
+    while stack:
+        node = pop()
+        if type(node) is Call:
+            func = node.func
             if (
-                type(call.func) is ast.Attribute
-                and type(call.func.value) is ast.Name
-                and call.func.value.id in MODULES
+                type(func) is Attribute
+                and type(value := func.value) is Name
+                and value.id in MODULES
             ):
-                number[call.func.value.id + call.func.attr] += 1
+                hits[value.id, func.attr] += 1
+        for field in node._fields:
+            child = getattr(node, field, None)
+            if type(child) is list:
+                for item in child:
+                    if isinstance(item, AST) and type(item) not in leaves:
+                        push(item)
+            elif isinstance(child, AST) and type(child) not in leaves:
+                push(child)
 
+    number = Counter()
+    for (module, attr), count in hits.items():
+        number[_call_key(module, attr)] += count
     return number
 
 
-def process_packages(directory):
-    number = Counter()
-    for index, package in enumerate(directory.iterdir(), 1):
-        if package.is_dir():
-            number.update(process_package(package))
-        if index % 50 == 0:
-            print(", ".join(f"{k} ({v})" for k, v in number.most_common(10)))
+def benchmark(directory, repeat=3):
+    """Time both call matchers over the same pre-parsed files."""
+    trees = []
+    for file in iter_files([directory]):
+        with open(file, "rb") as stream:
+            if (parsed := parse_source(stream.read())) is not None:
+                trees.append(parsed)
+
+    print(f"{len(trees)} files")
+    results = {}
+    for func in (count_module_calls_walk, count_module_calls):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            number = Counter()
+            for source, tree in trees:
+                number.update(func(source, tree))
+            best = min(best, time.perf_counter() - start)
+        results[func.__name__] = number
+        print(f"{func.__name__}: {best:.3f}s (best of {repeat})")
+    assert results["count_module_calls_walk"] == results["count_module_calls"]
+
+
+@register("calls")
+def call_analysis():
+    return CounterAnalysis(count_module_calls, needs_source=False)
+
+
+def process_files(files, cache=None):
+    analysis = call_analysis()
+    scan(files, [analysis], cache)
+    return analysis.counter
+
+
+def process_chunk(items, cache=None):
+    """Process (package, file) pairs; returns {package: (files, counts)}."""
+    files = defaultdict(list)
+    for package, file in items:
+        files[package].append(file)
+    return {
+        package: (len(package_files), process_files(package_files, cache))
+        for package, package_files in files.items()
+    }
+
+
+def process_package(directory, cache=None):
+    return process_files(iter_files([directory]), cache)
+
+
+class Journal:
+    """Append-only log of finished packages, one JSON line each with the
+    package's own counts. A crash loses at most the unflushed tail, and
+    a torn last line is discarded on load."""
+
+    def __init__(self, path, resume=False):
+        self.path = Path(path)
+        self.stream = open(self.path, "a" if resume else "w")
+
+    def entries(self):
+        """Yield (package, counts, end offset) for every intact line."""
+        offset = 0
+        with open(self.path, "rb") as stream:
+            for line in stream:
+                # A line without its newline is torn even if the JSON in
+                # it happens to be complete.
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                offset += len(line)
+                yield entry["package"], entry["counts"], offset
+
+    def load(self):
+        number, done, offset = Counter(), set(), 0
+        for package, counts, offset in self.entries():
+            number.update(counts)
+            done.add(package)
+
+        # Drop a torn tail so new entries start on a fresh line.
+        os.truncate(self.path, offset)
+        return number, done
+
+    def record(self, package, counts):
+        entry = {"package": package, "counts": counts}
+        self.stream.write(json.dumps(entry) + "\n")
+
+    def checkpoint(self):
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+
+    def close(self):
+        self.checkpoint()
+        self.stream.close()
+
+
+COLUMNS = ("package", "module", "attr")
+
+
+def export_columns(journal, directory):
+    """Write the journal as a columnar table: one dictionary-encoded
+    uint32 array per string column plus a uint64 count array, each a raw
+    native-endian file that array.fromfile (or numpy.fromfile) loads in
+    one go. schema.json describes the layout."""
+    directory.mkdir(parents=True, exist_ok=True)
+    codes = {column: array("I") for column in COLUMNS}
+    values = {column: {} for column in COLUMNS}
+    counts = array("Q")
+    for package, package_counts, _ in journal.entries():
+        for key, count in package_counts.items():
+            module, _, attr = key.partition(".")
+            for column, value in zip(COLUMNS, (package, module, attr)):
+                code = values[column].setdefault(value, len(values[column]))
+                codes[column].append(code)
+            counts.append(count)
+
+    schema = {"rows": len(counts), "byteorder": sys.byteorder, "columns": {}}
+    for column in COLUMNS:
+        with open(directory / f"{column}.bin", "wb") as stream:
+            codes[column].tofile(stream)
+        with open(directory / f"{column}.json", "w") as stream:
+            json.dump(list(values[column]), stream)
+        schema["columns"][column] = {
+            "type": codes[column].typecode,
+            "dictionary": f"{column}.json",
+        }
+    with open(directory / "count.bin", "wb") as stream:
+        counts.tofile(stream)
+    schema["columns"]["count"] = {"type": counts.typecode}
+
+    with open(directory / "schema.json", "w") as stream:
+        json.dump(schema, stream, indent=4)
+
+
+def read_columns(directory):
+    """Load a table written by export_columns. Returns (columns,
+    dictionaries): typed arrays by column name, and for dictionary
+    encoded columns the list that their codes index into."""
+    with open(directory / "schema.json") as stream:
+        schema = json.load(stream)
+
+    columns, dictionaries = {}, {}
+    for column, spec in schema["columns"].items():
+        data = array(spec["type"])
+        with open(directory / f"{column}.bin", "rb") as stream:
+            data.fromfile(stream, schema["rows"])
+        if schema["byteorder"] != sys.byteorder:
+            data.byteswap()
+        columns[column] = data
+        if "dictionary" in spec:
+            with open(directory / spec["dictionary"]) as stream:
+                dictionaries[column] = json.load(stream)
+    return columns, dictionaries
+
+
+def print_progress(number):
+    print(", ".join(f"{k} ({v})" for k, v in number.most_common(10)))
+
+
+def process_packages(
+    directory, cache=None, jobs=None, chunk_size=64, journal=None
+):
+    # Work is split into chunks of files rather than whole packages, so
+    # a few giant packages can't keep one worker busy long after the
+    # others ran dry. A package is journaled once all its files have
+    # been enumerated and every chunk holding them has come back.
+    number, done = Counter(), set()
+    if journal is not None:
+        number, done = journal.load()
+
+    pending = {}  # package -> [outstanding files, counts]
+    enumerated = set()
+
+    def finish(package):
+        outstanding, counts = pending[package]
+        if outstanding or package not in enumerated:
+            return
+        del pending[package]
+        if journal is not None:
+            journal.record(package, counts)
+
+    def iter_package_files():
+        for package in directory.iterdir():
+            if not package.is_dir() or package.name in done:
+                continue
+            state = pending[package.name] = [0, Counter()]
+            for file in iter_files([package]):
+                state[0] += 1
+                yield package.name, file
+            enumerated.add(package.name)
+            finish(package.name)
+
+    with ProcessPoolExecutor(jobs) as executor:
+        for index, result in enumerate(
+            imap_unordered(
+                executor,
+                partial(process_chunk, cache=cache),
+                chunked(iter_package_files(), chunk_size),
+            ),
+            1,
+        ):
+            for package, (files, counts) in result.items():
+                pending[package][0] -= files
+                pending[package][1].update(counts)
+                number.update(counts)
+                finish(package)
+            if index % 50 == 0:
+                print_progress(number)
+                if journal is not None:
+                    journal.checkpoint()
     return number
 
 
-results = process_packages(Path("disk/rawdata/clean/"))
-with open("func_res", "w") as f:
-    f.write(repr(results))
+def main(args=None):
+    parser = ArgumentParser()
+    parser.add_argument(
+        "directory", type=Path, nargs="?", default="disk/rawdata/clean/"
+    )
+    parser.add_argument(
+        "--cache", type=ResultCache, help="directory for cached results"
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes")
+    parser.add_argument(
+        "--chunk-size", type=int, default=64, help="files per task"
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        default="func_res.journal",
+        help="append-only checkpoint of finished packages",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip packages already recorded in the journal",
+    )
+    parser.add_argument(
+        "--export",
+        type=Path,
+        help="also write per-package counts as a columnar table here",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="compare the call matchers on the directory and exit",
+    )
+
+    options = parser.parse_args(args)
+    if options.benchmark:
+        return benchmark(options.directory)
+
+    journal = Journal(options.journal, options.resume)
+    try:
+        results = process_packages(
+            options.directory,
+            options.cache,
+            options.jobs,
+            options.chunk_size,
+            journal,
+        )
+    finally:
+        journal.close()
+    with open("func_res", "w") as f:
+        f.write(repr(results))
+    if options.export is not None:
+        export_columns(journal, options.export)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,726 @@
+"""Parse-once corpus engine.
+
+Every .py file is read, decoded and parsed exactly once, and the
+resulting tree is fanned out to all registered analyses in a single
+sweep.
+
+$ python corpus.py disk/rawdata/clean/ -a keywords -a calls -a finally
+$ python corpus.py src/ tools/ -a finally --exclude '*/vendor' -j 8 \\
+      --format jsonl --fail-on-match
+"""
+
+import ast
+import fnmatch
+import hashlib
+import heapq
+import importlib
+import inspect
+import io
+import itertools
+import json
+import mmap
+import os
+import pickle
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tokenize
+from argparse import ArgumentParser
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import partial
+from pathlib import Path
+from pprint import pprint
+from queue import Queue
+from threading import Thread
+
+# Modules that register analyses when imported.
+SCANNERS = (
+    "most_used_keyword",
+    "collect_comp_stats",
+    "find_finally_return",
+    "import_eafpvslbyl.scan",
+)
+
+ANALYSES = {}
+
+
+def register(name):
+    def wrapper(factory):
+        ANALYSES[name] = factory
+        return factory
+
+    return wrapper
+
+
+class ExtendedVisitor(ast.NodeVisitor):
+    needs_tree = True
+    needs_source = False
+    # Byte strings of which at least one must occur in a file for this
+    # visitor to possibly match; files without any are never parsed.
+    required = None
+    # Opt in to sharing a single tree walk with other visitors (see
+    # visit_all); only safe if every visit_* handler calls
+    # generic_visit() as the last thing it does, if at all.
+    dispatch = False
+
+    def __init__(self, filename=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filename = filename
+        self.count = 0
+
+        self.logs = []
+
+    def feed(self, path, source, tree):
+        self.merge(self.compute(path, source, tree))
+
+    def compute(self, path, source, tree):
+        visitor = type(self)(path)
+        visitor.visit(tree)
+        return visitor.count, visitor.logs
+
+    def merge(self, result):
+        count, logs = result
+        self.count += count
+        self.logs.extend(logs)
+
+    def result(self):
+        return self.count, self.logs
+
+
+_HANDLERS = {}
+
+
+def _handlers(cls):
+    """Map node class names to the visit_* method names of a visitor."""
+    if cls not in _HANDLERS:
+        _HANDLERS[cls] = [
+            (name.removeprefix("visit_"), name)
+            for name in dir(cls)
+            if name.startswith("visit_")
+        ]
+    return _HANDLERS[cls]
+
+
+def dispatchable(visitor):
+    # Visitors that haven't opted in, or that have a custom traversal,
+    # walk the tree themselves.
+    cls = type(visitor)
+    return (
+        isinstance(visitor, ExtendedVisitor)
+        and cls.dispatch
+        and cls.visit is ast.NodeVisitor.visit
+        and cls.generic_visit is ast.NodeVisitor.generic_visit
+    )
+
+
+def visit_all(visitors, tree):
+    """Walk the tree once, calling each visitor's visit_* handlers for
+    the node types it defines. generic_visit() only marks the node's
+    children to be visited later, after the handler has returned; a
+    handler that returns without calling it prunes that subtree for its
+    own visitor only. So the result matches running each visitor
+    separately only when every handler calls generic_visit() as its
+    last step (never e.g. enter/generic_visit/exit), which is what a
+    visitor's dispatch = True promises."""
+    table = defaultdict(list)
+    descend = [False] * len(visitors)
+    for index, visitor in enumerate(visitors):
+
+        def generic_visit(node, index=index):
+            descend[index] = True
+
+        visitor.generic_visit = generic_visit
+        for node_name, name in _handlers(type(visitor)):
+            table[node_name].append((index, getattr(visitor, name)))
+
+    try:
+        stack = [(tree, frozenset(range(len(visitors))))]
+        while stack:
+            node, active = stack.pop()
+            for index, handler in table.get(type(node).__name__, ()):
+                if index in active:
+                    descend[index] = False
+                    handler(node)
+                    if not descend[index]:
+                        active = active - {index}
+            if active:
+                children = list(ast.iter_child_nodes(node))
+                stack.extend((child, active) for child in reversed(children))
+    finally:
+        for visitor in visitors:
+            del visitor.generic_visit
+
+
+class CounterAnalysis:
+    """Wrap a func(source, tree) -> Counter into an analysis. Functions
+    that only look at the source can pass needs_tree=False, which lets
+    the engine skip ast.parse (tree is None then), and ones that only
+    look at the tree can pass needs_source=False, which lets it parse the
+    raw bytes without decoding them (source is None then). The function
+    may return None to reject a file."""
+
+    required = None
+
+    def __init__(self, func, needs_tree=True, needs_source=True):
+        self.func = func
+        self.needs_tree = needs_tree
+        self.needs_source = needs_source
+        self.counter = Counter()
+
+    def feed(self, path, source, tree):
+        self.merge(self.compute(path, source, tree))
+
+    def compute(self, path, source, tree):
+        return self.func(source, tree)
+
+    def merge(self, result):
+        self.counter.update(result)
+
+    def result(self):
+        return self.counter
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ResultCache:
+    """On-disk cache of per-file analysis results.
+
+    Entries are keyed by the file's name as the analyses see it (its
+    path, or label(path) when scan() is given a label) and content, the
+    interpreter version and the source of both this engine and the
+    module defining the analysis, so editing a visitor invalidates only
+    its own results.
+    Each entry is a small pickle written atomically, which keeps the
+    cache safe to share between worker processes."""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self._tokens = {}
+
+    def _analysis_token(self, analysis):
+        target = getattr(analysis, "func", type(analysis))
+        key = (target.__module__, target.__qualname__)
+        if key not in self._tokens:
+            self._tokens[key] = hashlib.sha256(
+                "\0".join(
+                    (
+                        sys.version,
+                        target.__qualname__,
+                        _file_digest(__file__),
+                        _file_digest(inspect.getsourcefile(target)),
+                    )
+                ).encode()
+            ).hexdigest()
+        return self._tokens[key]
+
+    def _entry(self, analysis, name, data):
+        digest = hashlib.sha256(self._analysis_token(analysis).encode())
+        digest.update(os.fsencode(name))
+        digest.update(b"\0")
+        digest.update(data)
+        key = digest.hexdigest()
+        return self.directory / key[:2] / key
+
+    def get(self, analysis, name, data):
+        try:
+            with open(self._entry(analysis, name, data), "rb") as f:
+                return True, pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def put(self, analysis, name, data, result):
+        entry = self._entry(analysis, name, data)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=entry.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+
+def decode_source(data):
+    # One decoded copy; newlines are only rewritten in the rare files
+    # that actually contain a carriage return.
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    content = data.decode(encoding)
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    return content
+
+
+def parse_source(data, needs_tree=True, needs_source=True):
+    """Return (source, tree), either of which is None when not needed,
+    or None for invalid files. Without needs_source the raw bytes go
+    straight to ast.parse, which honours coding cookies and BOMs and
+    normalizes newlines itself. Files too deeply nested for the parser
+    (RecursionError, MemoryError) count as invalid too."""
+    try:
+        source = decode_source(data) if needs_source else None
+        if not needs_tree:
+            return source, None
+        return source, ast.parse(data if source is None else source)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return None
+
+
+def _legacy_parse(path):
+    # The reader every scanner used to have, kept for benchmark_memory().
+    with tokenize.open(path) as f:
+        content = f.read()
+
+    content = content.replace("\r\n", "\n").replace("\r", "\n").strip()
+    if not content.endswith("\n"):
+        content += "\n"
+    return content, ast.parse(content)
+
+
+def _read_parse(path, **kwargs):
+    with open(path, "rb") as f:
+        return parse_source(f.read(), **kwargs)
+
+
+READERS = {
+    "none": lambda path: None,
+    "legacy": _legacy_parse,
+    "source": _read_parse,
+    "bytes": partial(_read_parse, needs_source=False),
+}
+
+
+def _peak_rss(reader, path):
+    code = (
+        "import corpus, resource, sys;"
+        "corpus.READERS[sys.argv[1]](sys.argv[2]);"
+        "print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", code, reader, path],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return int(process.stdout)
+
+
+def benchmark_memory(root, count=5):
+    """Peak RSS of reading and parsing each of the `count` largest files
+    under root, one fresh interpreter per measurement, relative to an
+    interpreter that only imports this module."""
+    largest = heapq.nlargest(
+        count, ((os.stat(path).st_size, path) for path in iter_files([root]))
+    )
+    for size, path in largest:
+        base = _peak_rss("none", path)
+        peaks = ", ".join(
+            f"{reader} +{(_peak_rss(reader, path) - base) / 1024:.1f}MiB"
+            for reader in ("legacy", "source", "bytes")
+        )
+        print(f"{path} ({size / 1024:.0f}KiB): {peaks}")
+
+
+def read_wanted(path, analyses):
+    """Return the file's bytes and the analyses that may match it. For
+    analyses declaring required tokens, the file is mmapped and searched
+    first; when no analysis wants it, it is never read into memory and
+    (None, []) is returned."""
+    with open(path, "rb") as f:
+        if all(analysis.required is None for analysis in analyses):
+            return f.read(), analyses
+
+        try:
+            view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can't be mapped, nor contain any token.
+            view = b""
+        try:
+            wanted = [
+                analysis
+                for analysis in analyses
+                if analysis.required is None
+                or any(view.find(token) != -1 for token in analysis.required)
+            ]
+            return (view[:] if wanted else None), wanted
+        finally:
+            if isinstance(view, mmap.mmap):
+                view.close()
+
+
+def scan(files, analyses, cache=None, label=None):
+    """Parse each file once and feed it to every analysis. Files are
+    only decoded, not parsed, when no analysis needs a tree, and the
+    ExtendedVisitors that opt in with dispatch = True share a single
+    walk over it. Analyses see
+    label(path) as the file name when a label function is given. Returns
+    the number of files that were successfully parsed (or served
+    entirely from the cache); files skipped by the required token
+    prefilter don't count."""
+    parsed = 0
+    for path in files:
+        try:
+            data, wanted = read_wanted(path, analyses)
+        except OSError:
+            continue
+        if not wanted:
+            continue
+
+        # Results hold the labelled name (e.g. in ExtendedVisitor logs),
+        # so that, not the raw path, is what the cache is keyed on.
+        name = path if label is None else label(path)
+        pending, valid = [], False
+        for analysis in wanted:
+            hit, result = False, None
+            if cache is not None:
+                hit, result = cache.get(analysis, name, data)
+            if not hit:
+                pending.append(analysis)
+            elif result is not None:
+                analysis.merge(result)
+                valid = True
+
+        if not pending:
+            parsed += valid
+            continue
+
+        needs_tree = any(analysis.needs_tree for analysis in pending)
+        needs_source = any(analysis.needs_source for analysis in pending)
+        if (
+            parsed_source := parse_source(data, needs_tree, needs_source)
+        ) is None:
+            # Remember invalid files too, so they are not re-parsed.
+            if cache is not None:
+                for analysis in pending:
+                    cache.put(analysis, name, data, None)
+            continue
+
+        source, tree = parsed_source
+        results = {}
+        if visitors := [
+            analysis for analysis in pending if dispatchable(analysis)
+        ]:
+            fresh = [type(visitor)(name) for visitor in visitors]
+            visit_all(fresh, tree)
+            for visitor, done in zip(visitors, fresh):
+                results[visitor] = done.count, done.logs
+
+        for analysis in pending:
+            if analysis in results:
+                result = results[analysis]
+            else:
+                result = analysis.compute(name, source, tree)
+            if cache is not None:
+                cache.put(analysis, name, data, result)
+            if result is not None:
+                analysis.merge(result)
+        parsed += 1
+    return parsed
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def imap_unordered(executor, func, iterable, window=None):
+    """Like executor.map, but yields results as they complete and keeps
+    at most `window` tasks in flight, so huge inputs are never fully
+    submitted up front."""
+    if window is None:
+        window = 4 * executor._max_workers
+
+    iterator = iter(iterable)
+    pending = {
+        executor.submit(func, item)
+        for item in itertools.islice(iterator, window)
+    }
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+        for item in itertools.islice(iterator, len(done)):
+            pending.add(executor.submit(func, item))
+
+
+def imap(executor, func, iterable, window=None):
+    """Ordered counterpart of imap_unordered: results are yielded in
+    input order, still with a bounded number of tasks in flight."""
+    if window is None:
+        window = 4 * executor._max_workers
+
+    iterator = iter(iterable)
+    pending = deque(
+        executor.submit(func, item)
+        for item in itertools.islice(iterator, window)
+    )
+    while pending:
+        yield pending.popleft().result()
+        for item in itertools.islice(iterator, 1):
+            pending.append(executor.submit(func, item))
+
+
+def _scan_chunk(factories, cache, label, files):
+    results = []
+    for path in files:
+        analyses = [factory() for factory in factories]
+        if scan([path], analyses, cache, label):
+            results.append([analysis.result() for analysis in analyses])
+    return results
+
+
+def parallel_scan(
+    files, factories, jobs=None, cache=None, label=None, chunk_size=64
+):
+    """scan() across worker processes. factories are picklable
+    zero-argument callables (analysis classes or registered factories);
+    each builds the analysis a worker runs over one file. Per-file results
+    are merged back in input order, so logs come out exactly as a serial
+    scan would produce them. Returns the merged analyses."""
+    analyses = [factory() for factory in factories]
+    with ProcessPoolExecutor(jobs) as executor:
+        for results in imap(
+            executor,
+            partial(_scan_chunk, factories, cache, label),
+            chunked(files, chunk_size),
+        ):
+            for file_results in results:
+                for analysis, result in zip(analyses, file_results):
+                    analysis.merge(result)
+    return analyses
+
+
+def load_scanners():
+    for module in SCANNERS:
+        importlib.import_module(module)
+
+
+def _pattern(patterns):
+    if not patterns:
+        return None
+    return re.compile("|".join(map(fnmatch.translate, patterns))).match
+
+
+def iter_files(roots, include="*.py", exclude=(), follow_symlinks=False):
+    """Stream files under roots whose name matches include, in sorted
+    order, using one os.scandir() per directory and a depth-first stack
+    of pending directories. Nothing is collected up front, but each
+    directory's listing is read whole (to sort it) and the stack holds
+    the pending siblings at every level, so memory grows with depth
+    times fan-out: a flat directory of N packages costs O(N) names,
+    just not O(files). Exclude patterns are matched against
+    both the path and the base name; excluded directories are pruned
+    without being listed. Symlinked directories are skipped unless
+    follow_symlinks is set, in which case each directory is entered at
+    most once so symlink loops terminate."""
+    included = _pattern([include])
+    excluded = _pattern(exclude) or (lambda name: False)
+    for root in map(os.fspath, roots):
+        if not os.path.isdir(root):
+            yield root
+            continue
+
+        seen = set()
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                if follow_symlinks:
+                    stat = os.stat(directory)
+                    if (key := (stat.st_dev, stat.st_ino)) in seen:
+                        continue
+                    seen.add(key)
+                with os.scandir(directory) as iterator:
+                    entries = sorted(iterator, key=lambda entry: entry.name)
+            except OSError:
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                if excluded(entry.path) or excluded(entry.name):
+                    continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+                except OSError:
+                    continue
+                if is_dir:
+                    subdirectories.append(entry.path)
+                elif included(entry.name) and not entry.is_dir():
+                    # (the second is_dir() follows links, so an unfollowed
+                    # symlink to a directory isn't mistaken for a file)
+                    yield entry.path
+            stack.extend(reversed(subdirectories))
+
+
+def prefetch(iterable, size=4096):
+    """Run iterable in a background thread, at most size items ahead of
+    the consumer. Lets file discovery overlap with feeding workers."""
+    queue = Queue(size)
+    done = object()
+    error = None
+
+    def fill():
+        nonlocal error
+        try:
+            for item in iterable:
+                queue.put(item)
+        except BaseException as exc:
+            error = exc
+        finally:
+            queue.put(done)
+
+    Thread(target=fill, daemon=True).start()
+    while (item := queue.get()) is not done:
+        yield item
+    if error is not None:
+        raise error
+
+
+def benchmark_walk(roots, include="*.py"):
+    """Files/second for iter_files against os.walk and Path.glob."""
+    walkers = {
+        "iter_files": lambda: iter_files(roots, include),
+        "os.walk": lambda: (
+            os.path.join(dirpath, filename)
+            for root in roots
+            for dirpath, _, filenames in os.walk(root)
+            for filename in filenames
+            if fnmatch.fnmatch(filename, include)
+        ),
+        "Path.glob": lambda: (
+            path for root in roots for path in Path(root).glob("**/" + include)
+        ),
+    }
+    for name, walker in walkers.items():
+        start = time.perf_counter()
+        count = sum(1 for _ in walker())
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {count} files, {count / elapsed:,.0f} files/s")
+
+
+def report(names, analyses, output_format, stream=sys.stdout):
+    for name, analysis in zip(names, analyses):
+        if isinstance(analysis, ExtendedVisitor):
+            if output_format == "text":
+                print(f"== {name}", file=stream)
+                print("Total matches:", analysis.count, file=stream)
+                for line in analysis.logs:
+                    print(line, file=stream)
+            else:
+                for line in analysis.logs:
+                    path, _, lineno = str(line).rpartition(":")
+                    record = {"rule": name, "path": path, "line": int(lineno)}
+                    print(json.dumps(record), file=stream)
+        elif output_format == "text":
+            print(f"== {name}", file=stream)
+            pprint(analysis.result(), stream=stream)
+        else:
+            for key, count in analysis.result().most_common():
+                record = {"rule": name, "key": key, "count": count}
+                print(json.dumps(record), file=stream)
+
+
+def main(args=None):
+    load_scanners()
+
+    parser = ArgumentParser()
+    parser.add_argument("roots", nargs="+", type=Path)
+    parser.add_argument(
+        "-a",
+        "--analysis",
+        action="append",
+        choices=sorted(ANALYSES),
+        help="analyses to run (default: all)",
+    )
+    parser.add_argument(
+        "--include",
+        default="*.py",
+        help="file name pattern to scan (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="path or name pattern to skip; prunes whole directories",
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="worker processes"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="text report, or one JSON object per match",
+    )
+    parser.add_argument(
+        "--fail-on-match",
+        action="store_true",
+        help="exit with status 1 if any rule matched",
+    )
+    parser.add_argument(
+        "--cache", type=ResultCache, help="directory for cached results"
+    )
+    parser.add_argument(
+        "--follow-symlinks",
+        action="store_true",
+        help="descend into symlinked directories (loops are detected)",
+    )
+    parser.add_argument(
+        "--benchmark-walk",
+        action="store_true",
+        help="measure file discovery throughput and exit",
+    )
+    parser.add_argument(
+        "--benchmark-memory",
+        action="store_true",
+        help="measure reader peak RSS on the largest files and exit",
+    )
+
+    options = parser.parse_args(args)
+    if options.benchmark_memory:
+        for root in options.roots:
+            benchmark_memory(root)
+        return
+    if options.benchmark_walk:
+        return benchmark_walk(options.roots, options.include)
+
+    names = options.analysis or sorted(ANALYSES)
+    files = iter_files(
+        options.roots,
+        options.include,
+        options.exclude,
+        options.follow_symlinks,
+    )
+    if options.jobs == 1:
+        analyses = [ANALYSES[name]() for name in names]
+        scan(files, analyses, options.cache)
+    else:
+        analyses = parallel_scan(
+            prefetch(files),
+            [ANALYSES[name] for name in names],
+            options.jobs,
+            options.cache,
+        )
+
+    report(names, analyses, options.format)
+    if options.fail_on_match and any(
+        analysis.count
+        for analysis in analyses
+        if isinstance(analysis, ExtendedVisitor)
+    ):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Scanners register into the importable `corpus` module, not __main__.
+    import corpus
+
+    corpus.main()
@@ -1,7 +1,18 @@
 import sys
+import filecmp
+import hashlib
+import io
+import os
+import pickle
 import pyclbr
+import sqlite3
+import subprocess
+import tempfile
 import tokenize
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pprint import pprint
 
 from argparse import ArgumentParser
@@ -22,14 +33,70 @@ def qualified_name(entry):
     else:
         return entry.name
 
-def get_tree(path, module):
-    with tokenize.open(path) as stream:
-        source = stream.read()
+# Picklable stand-in for pyclbr objects; children is only filled for classes.
+Entry = namedtuple("Entry", ["name", "qualname", "kind", "lineno", "children"])
+
+def summarize(tree):
+    summary = {}
+    for name, entry in tree.items():
+        if isinstance(entry, pyclbr.Class):
+            summary[name] = Entry(entry.name, qualified_name(entry), "class", entry.lineno, summarize(entry.children))
+        else:
+            summary[name] = Entry(entry.name, qualified_name(entry), "function", entry.lineno, {})
+    return summary
+
+class TreeCache:
+    # Pickled tree summaries, keyed by module name, file content, interpreter
+    # version and this script's own source.
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        with open(__file__, "rb") as stream:
+            self.token = hashlib.sha256(sys.version.encode() + stream.read()).digest()
+
+    def _entry(self, module, data):
+        key = hashlib.sha256(self.token + module.encode() + b"\0" + data).hexdigest()
+        return self.directory / key[:2] / key
+
+    def get(self, module, data):
+        try:
+            with open(self._entry(module, data), "rb") as stream:
+                return pickle.load(stream)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def put(self, module, data, tree):
+        entry = self._entry(module, data)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=entry.parent)
+        try:
+            with os.fdopen(fd, "wb") as stream:
+                pickle.dump(tree, stream, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, entry)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+def get_tree(path, module, source=None):
+    if source is None:
+        with tokenize.open(path) as stream:
+            source = stream.read()
 
     tree = {}
     pyclbr._create_tree(module, None, path, source, tree, False)    
     return tree
 
+def get_summary(path, module, cache=None):
+    data = path.read_bytes()
+    if cache is not None and (summary := cache.get(module, data)) is not None:
+        return summary
+
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    summary = summarize(get_tree(path, module, data.decode(encoding)))
+    if cache is not None:
+        cache.put(module, data, summary)
+    return summary
+
 def collect_entries(tree, keys):
     for key in keys:
         entry = tree[key]
@@ -44,8 +111,8 @@ def compare_tree(base_tree, active_tree):
     removed.extend(collect_entries(base_tree, base_tree.keys() ^ common_top_levels))
     for common_entry in common_top_levels:
         if not (
-            isinstance(base_class := base_tree[common_entry], pyclbr.Class)
-            and isinstance(active_class := active_tree[common_entry], pyclbr.Class)
+            (base_class := base_tree[common_entry]).kind == "class"
+            and (active_class := active_tree[common_entry]).kind == "class"
         ):
             continue
         common_sub_levels = base_class.children.keys() & active_class.children.keys()
@@ -54,44 +121,267 @@ def compare_tree(base_tree, active_tree):
     return added, removed
 
 
-def generate_index(base_path, active_path):
-    module_index = defaultdict(dict)
-    for base_file in base_path.glob("**/*.py"):
-        file_name = str(base_file.relative_to(base_path))
-        active_file = active_path / file_name
+def iter_module_files(path):
+    for file in sorted(path.glob("**/*.py")):
+        file_name = str(file.relative_to(path))
         module_name = file_name.replace('/', '.').removesuffix('.py')
         if 'test.' in module_name or '.tests' in module_name or 'encoding' in module_name or 'idle_test' in module_name:
             continue
+        yield module_name, file
 
-        print('processing ', module_name)
-        try:
-            base_tree = get_tree(base_file, module_name)
-            active_tree = get_tree(active_file, module_name)
-        except (SyntaxError, FileNotFoundError):
+def iter_modules(base_path, active_path):
+    for module_name, base_file in iter_module_files(base_path):
+        active_file = active_path / base_file.relative_to(base_path)
+        yield base_file, active_file, module_name
+
+def diff_module(task, cache=None):
+    # Returns (status, added, removed) where status is one of
+    # 'processed', 'skipped' or 'failed'.
+    base_file, active_file, module_name = task
+    try:
+        # Byte-identical files can't differ in their API.
+        if filecmp.cmp(base_file, active_file, shallow=False):
+            return 'skipped', [], []
+
+        base_tree = get_summary(base_file, module_name, cache)
+        active_tree = get_summary(active_file, module_name, cache)
+    except (SyntaxError, FileNotFoundError):
+        return 'failed', [], []
+
+    return 'processed', *compare_tree(base_tree, active_tree)
+
+def map_tasks(func, tasks, jobs=1):
+    if jobs == 1:
+        yield from map(func, tasks)
+        return
+
+    with ProcessPoolExecutor(jobs) as executor:
+        yield from executor.map(func, tasks, chunksize=16)
+
+def generate_index(base_path, active_path, cache=None, jobs=1):
+    module_index = defaultdict(dict)
+    skipped = 0
+    tasks = list(iter_modules(base_path, active_path))
+    # executor.map yields in submission order, so the index is built in
+    # sorted module order no matter which worker finishes first.
+    results = map_tasks(partial(diff_module, cache=cache), tasks, jobs)
+    for (_, _, module_name), (status, added, removed) in zip(tasks, results):
+        if status == 'skipped':
+            skipped += 1
             continue
-        
-        added, removed = compare_tree(base_tree, active_tree)
+        if status == 'processed':
+            print('processing ', module_name)
         if added:
             module_index[module_name]['added'] = added
         if removed:
             module_index[module_name]['removed'] = removed
 
+    print(f'skipped {skipped} unchanged files')
     for module, status in module_index.items():
         print('module: ', module)
         if added := status.get("added"):
-            print("added: ", [qualified_name(entry) for entry in added])
+            print("added: ", [entry.qualname for entry in added])
         if removed := status.get("removed"):
-            print("removed: ", [qualified_name(entry) for entry in removed])
+            print("removed: ", [entry.qualname for entry in removed])
         
     pprint(module_index)
+    return module_index
+
+def summary_task(task, cache=None):
+    module_name, file = task
+    try:
+        return get_summary(file, module_name, cache)
+    except SyntaxError:
+        return None
+
+def build_timeline(paths, labels, cache=None, jobs=1):
+    # Every distinct (module, content) pair is summarized exactly once, no
+    # matter how many revisions share it, and then adjacent revisions are
+    # diffed from those summaries. Returns
+    # {module: {qualname: [(label, 'added' | 'removed', entry), ...]}}.
+    revisions = []
+    unique = {}
+    for path in paths:
+        digests = {}
+        for module_name, file in iter_module_files(path):
+            digest = hashlib.sha256(file.read_bytes()).digest()
+            digests[module_name] = digest
+            unique.setdefault((module_name, digest), file)
+        revisions.append(digests)
+
+    print(f'summarizing {len(unique)} distinct files')
+    tasks = [(module_name, file) for (module_name, _), file in unique.items()]
+    summaries = dict(zip(unique, map_tasks(partial(summary_task, cache=cache), tasks, jobs)))
+
+    timeline = defaultdict(lambda: defaultdict(list))
+    for label, base, active in zip(labels[1:], revisions, revisions[1:]):
+        for module_name in sorted(base.keys() | active.keys()):
+            if base.get(module_name) == active.get(module_name):
+                continue
+
+            # A module that doesn't exist yet (or anymore) is an empty tree,
+            # so all of its names show up as added (or removed).
+            trees = []
+            for digests in (base, active):
+                if module_name not in digests:
+                    trees.append({})
+                else:
+                    trees.append(summaries[module_name, digests[module_name]])
+            if None in trees:
+                continue
+
+            added, removed = compare_tree(*trees)
+            for entry in added:
+                timeline[module_name][entry.qualname].append((label, 'added', entry))
+            for entry in removed:
+                timeline[module_name][entry.qualname].append((label, 'removed', entry))
+    return timeline
+
+@contextmanager
+def git_worktrees(repo, revisions, subdir):
+    with tempfile.TemporaryDirectory() as directory:
+        worktrees = []
+        try:
+            for index, revision in enumerate(revisions):
+                worktree = Path(directory) / str(index)
+                subprocess.run(
+                    ["git", "-C", repo, "worktree", "add", "--quiet", "--detach", worktree, revision],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                )
+                worktrees.append(worktree)
+            yield [worktree / subdir for worktree in worktrees]
+        finally:
+            for worktree in worktrees:
+                subprocess.run(["git", "-C", repo, "worktree", "remove", "--force", worktree], check=False)
+
+def print_timeline(timeline):
+    for module in sorted(timeline):
+        print('module: ', module)
+        for qualname, events in sorted(timeline[module].items()):
+            changes = ' '.join(('+' if change == 'added' else '-') + label for label, change, _ in events)
+            print(f'    {qualname}: {changes}')
+
+def generate_timeline(paths, labels, cache=None, jobs=1):
+    timeline = build_timeline(paths, labels, cache, jobs)
+    print_timeline(timeline)
+    return timeline
+
+def index_to_timeline(module_index, label):
+    timeline = defaultdict(lambda: defaultdict(list))
+    for module, status in module_index.items():
+        for change in ('added', 'removed'):
+            for entry in status.get(change, ()):
+                timeline[module][entry.qualname].append((label, change, entry))
+    return timeline
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS revisions (
+    id INTEGER PRIMARY KEY,
+    label TEXT NOT NULL UNIQUE,
+    position INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    revision INTEGER NOT NULL REFERENCES revisions(id),
+    module TEXT NOT NULL,
+    qualname TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    lineno INTEGER,
+    change TEXT NOT NULL CHECK (change IN ('added', 'removed'))
+);
+CREATE INDEX IF NOT EXISTS changes_module ON changes (module, qualname);
+CREATE INDEX IF NOT EXISTS changes_qualname ON changes (qualname);
+"""
+
+def store_timeline(db, labels, timeline):
+    # A database holds one timeline; storing a new one replaces it. Changes
+    # are attributed to the revision that introduced them, so the first
+    # label only anchors 'since' queries.
+    with sqlite3.connect(db) as connection:
+        connection.executescript(SCHEMA)
+        connection.execute("DELETE FROM changes")
+        connection.execute("DELETE FROM revisions")
+        connection.executemany(
+            "INSERT INTO revisions (id, label, position) VALUES (?, ?, ?)",
+            [(position, label, position) for position, label in enumerate(labels)],
+        )
+        revision_ids = {label: position for position, label in enumerate(labels)}
+        connection.executemany(
+            "INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (revision_ids[label], module, qualname, entry.kind, entry.lineno, change)
+                for module, names in timeline.items()
+                for qualname, events in names.items()
+                for label, change, entry in events
+            ),
+        )
+    connection.close()
+
+def query_changes(db, module=None, qualname=None, since=None, change=None):
+    # module matches the module itself and its submodules; since=label
+    # returns changes made after that revision.
+    clauses, params = [], []
+    if module is not None:
+        # '/' sorts right after '.', so this is an index-friendly prefix match.
+        clauses.append("(module = ? OR (module >= ? AND module < ?))")
+        params.extend((module, module + '.', module + '/'))
+    if qualname is not None:
+        clauses.append("qualname = ?")
+        params.append(qualname)
+    if since is not None:
+        clauses.append("position > (SELECT position FROM revisions WHERE label = ?)")
+        params.append(since)
+    if change is not None:
+        clauses.append("change = ?")
+        params.append(change)
+
+    query = """
+        SELECT label, change, module, qualname, kind, lineno
+        FROM changes JOIN revisions ON changes.revision = revisions.id
+    """
+    if clauses:
+        query += " WHERE " + " AND ".join(clauses)
+    query += " ORDER BY position, module, qualname"
+
+    connection = sqlite3.connect(db)
+    try:
+        return connection.execute(query, params).fetchall()
+    finally:
+        connection.close()
 
 def main():
     parser = ArgumentParser()
-    parser.add_argument("baseline_path", type=Path)
-    parser.add_argument("current_path", type=Path)
+    parser.add_argument("paths", nargs="*", help="two or more checkouts, or git revisions with --git")
+    parser.add_argument("--git", type=Path, help="treat paths as revisions of this local repository")
+    parser.add_argument("--subdir", default="Lib", help="directory to index inside each git revision")
+    parser.add_argument("--cache", type=TreeCache, help="directory for cached trees")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="worker processes")
+    parser.add_argument("--db", type=Path, help="store the index in this SQLite database; without paths, query it")
+    parser.add_argument("--module", help="query: module (and submodules)")
+    parser.add_argument("--name", help="query: qualified name")
+    parser.add_argument("--since", help="query: only changes after this revision label")
+    parser.add_argument("--change", choices=["added", "removed"], help="query: kind of change")
 
     options = parser.parse_args()
-    generate_index(options.baseline_path, options.current_path)
-    
+    if not options.paths and options.db is not None:
+        for row in query_changes(options.db, options.module, options.name, options.since, options.change):
+            print(*row, sep='\t')
+        return
+    if len(options.paths) < 2:
+        parser.error("at least two paths are required")
+
+    if options.git is not None:
+        with git_worktrees(options.git, options.paths, options.subdir) as paths:
+            timeline = generate_timeline(paths, options.paths, options.cache, options.jobs)
+    elif len(options.paths) == 2:
+        base_path, current_path = map(Path, options.paths)
+        module_index = generate_index(base_path, current_path, options.cache, options.jobs)
+        timeline = index_to_timeline(module_index, options.paths[1])
+    else:
+        timeline = generate_timeline(list(map(Path, options.paths)), options.paths, options.cache, options.jobs)
+
+    if options.db is not None:
+        store_timeline(options.db, options.paths, timeline)
+
 if __name__ == "__main__":
     main()
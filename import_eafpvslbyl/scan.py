@@ -1,21 +1,27 @@
 import ast
-import itertools
 import os
-from contextlib import suppress
-from multiprocessing import Process
-from tokenize import open as fopen
+import sys
+from argparse import ArgumentParser
+from functools import partial
 
+sys.path.insert(
+    0, os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
 
-class ExtendedVisitor(ast.NodeVisitor):
-    def __init__(self, filename=None, *args, **kwargs):
-        super().__init__(*args, **kwargs)  # actualy does nothing
-        self.filename = filename
-        self.count = 0
-
-        self.logs = []
+from corpus import (
+    ExtendedVisitor,
+    iter_files,
+    parallel_scan,
+    register,
+    scan,
+)
 
 
+@register("import-eafp")
 class ImportEAFP(ExtendedVisitor):
+    required = (b"ImportError",)
+    dispatch = True
+
     def visit_Try(self, node):
         for handler in node.handlers:
             if (
@@ -29,7 +35,11 @@ class ImportEAFP(ExtendedVisitor):
         return self.generic_visit(node)
 
 
+@register("import-lbyl")
 class ImportLBYL(ExtendedVisitor):
+    required = (b"find_spec",)
+    dispatch = True
+
     def visit_Call(self, node):
         if not (
             isinstance(node.func, ast.Name) and node.func.id == "find_spec"
@@ -41,38 +51,38 @@ class ImportLBYL(ExtendedVisitor):
 
 
 def find_py_files(src):
-    if not os.path.isdir(src):
-        yield os.path.split(src)
-    for srcpath, _, fnames in os.walk(src):
-        yield from zip(
-            itertools.repeat(srcpath),
-            filter(lambda fname: fname.endswith(".py"), fnames),
-        )
-
-
-def visit_py_files(src, visitor):
-    for file in find_py_files(src):
-        with suppress(SyntaxError):
-            fname = os.path.join(*file)
-
-            with fopen(fname) as f:
-                content = f.read()
-
-            content = content.replace("\r\n", "\n").replace("\r", "\n").strip()
-            if not content.endswith("\n"):
-                content += "\n"
-
-            tree = ast.parse(content)
-            visitor.filename = file[-1]
-            visitor.visit(tree)
-
-
-if __name__ == "__main__":
-    path = os.path.dirname(os.__file__)
-
-    for Visitor in ExtendedVisitor.__subclasses__():
-        visitor = Visitor()
-        visit_py_files(path, visitor)
+    # Sorted, so reports come out in a stable path order.
+    for path in iter_files([src]):
+        yield os.path.split(path)
+
+
+def visit_py_files(src, *visitors, jobs=1):
+    files = (os.path.join(*file) for file in find_py_files(src))
+    label = partial(os.path.relpath, start=src)
+    if jobs == 1:
+        scan(files, visitors, label=label)
+        return
+
+    factories = [type(visitor) for visitor in visitors]
+    for visitor, done in zip(
+        visitors, parallel_scan(files, factories, jobs, label=label)
+    ):
+        visitor.merge(done.result())
+
+
+def main(args=None):
+    parser = ArgumentParser()
+    parser.add_argument(
+        "path", nargs="?", default=os.path.dirname(os.__file__)
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="worker processes"
+    )
+
+    options = parser.parse_args(args)
+    visitors = [Visitor() for Visitor in ExtendedVisitor.__subclasses__()]
+    visit_py_files(options.path, *visitors, jobs=options.jobs)
+    for visitor in visitors:
         with open(
             os.path.join(
                 os.path.dirname(__file__), visitor.__class__.__name__
@@ -82,3 +92,7 @@ if __name__ == "__main__":
             f.write(f"Total Matches: {visitor.count}\n\n")
             for line in visitor.logs:
                 f.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
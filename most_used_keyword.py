@@ -1,56 +1,219 @@
-import ast
+import io
 import keyword
+import os
+import re
+import time
 import tokenize
 from argparse import ArgumentParser
-from collections import Counter
+from collections import Counter, defaultdict
 from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from pprint import pprint
 
+from corpus import (
+    CounterAnalysis,
+    ResultCache,
+    imap_unordered,
+    iter_files,
+    register,
+    scan,
+)
+
 KEYWORDS = frozenset(keyword.kwlist)
 
+# Comments and string literals are matched (and thrown away) so that
+# keywords inside them are not counted; only the keyword alternative
+# has a capturing group.
+KEYWORD_PATTERN = re.compile(
+    r"""
+    \#[^\n]*
+    | (?<!\w)(?i:rb|br|fr|rf|[rbuf])?
+      (?: '''(?:\\[\s\S]|[^\\])*?'''
+        | \"\"\"(?:\\[\s\S]|[^\\])*?\"\"\"
+        | '(?:\\[\s\S]|[^\\'\n])*'
+        | "(?:\\[\s\S]|[^\\"\n])*"
+      )
+    | \b({})\b
+    """.format("|".join(keyword.kwlist)),
+    re.VERBOSE,
+)
 
-def process_project(project_dir):
-    counter = Counter()
-    for py_file in project_dir.glob("**/*.py"):
-        try:
-            stream = tokenize.open(py_file)
-            ast.parse(stream.read())
-        except (ValueError, SyntaxError):
-            continue
-        else:
-            stream.seek(0)
-
-        counter.update(
-            token.string
-            for token in tokenize.generate_tokens(stream.readline)
-            if token.type == tokenize.NAME
-            if token.string in KEYWORDS
-        )
-        stream.close()
+# Each worker should see this many batches on average, which keeps the
+# tail short without paying IPC for every tiny project.
+BATCHES_PER_WORKER = 16
+MIN_BATCH_BYTES = 64 * 1024
+
+
+def count_source_keywords(source, tree=None):
+    buffer = io.StringIO(source)
+    return Counter(
+        token.string
+        for token in tokenize.generate_tokens(buffer.readline)
+        if token.type == tokenize.NAME
+        if token.string in KEYWORDS
+    )
+
+
+def count_tokenized_keywords(source, tree=None):
+    # Without a parse, the tokenizer is the only validation: it rejects
+    # broken indentation and unterminated brackets or strings, but lets
+    # through files that are merely ungrammatical (e.g. Python 2).
+    try:
+        return count_source_keywords(source)
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+
+def count_regex_keywords(source, tree=None):
+    # No validation at all; the regex engine does the whole scan in C.
+    return Counter(filter(None, KEYWORD_PATTERN.findall(source)))
+
+
+# mode -> (counter function, whether the file must be fully parsed)
+MODES = {
+    "parse": (count_source_keywords, True),
+    "tokenize": (count_tokenized_keywords, False),
+    "regex": (count_regex_keywords, False),
+}
+
+
+@register("keywords")
+def keyword_analysis(mode="parse"):
+    func, needs_tree = MODES[mode]
+    return CounterAnalysis(func, needs_tree)
+
+
+def process_batch(files, cache=None, mode="parse"):
+    analysis = keyword_analysis(mode)
+    scan(files, [analysis], cache)
+    return analysis.counter
 
-    return counter
 
+def process_project(project_dir, cache=None, mode="parse"):
+    return process_batch(iter_files([project_dir]), cache, mode)
+
+
+def _timed(func, task):
+    start = time.perf_counter()
+    result = func(task)
+    return os.getpid(), time.perf_counter() - start, result
+
+
+def iter_projects(data_dir):
+    # Only directories are projects; loose files such as a README next
+    # to them are not scanned.
+    for project in data_dir.iterdir():
+        if project.is_dir():
+            yield project
+
+
+def project_tasks(data_dir, jobs):
+    return iter_projects(data_dir)
+
+
+def sized_tasks(data_dir, jobs):
+    """Pack files into batches of roughly equal source size, largest
+    files first, so the biggest work is started early and the rest fills
+    in behind it."""
+    files = []
+    for project in iter_projects(data_dir):
+        for py_file in iter_files([project]):
+            try:
+                files.append((os.stat(py_file).st_size, py_file))
+            except OSError:
+                continue
+    files.sort(key=lambda item: item[0], reverse=True)
+
+    total = sum(size for size, _ in files)
+    target = max(total // (jobs * BATCHES_PER_WORKER), MIN_BATCH_BYTES)
+
+    batch, batch_size = [], 0
+    for size, py_file in files:
+        batch.append(py_file)
+        batch_size += size
+        if batch_size >= target:
+            yield batch
+            batch, batch_size = [], 0
+    if batch:
+        yield batch
+
+
+STRATEGIES = {
+    "project": (project_tasks, process_project),
+    "sized": (sized_tasks, process_batch),
+}
+
+
+def count_keywords(
+    data_dir, cache=None, jobs=None, strategy="sized", mode="parse"
+):
+    jobs = jobs or os.cpu_count() or 1
+    make_tasks, process = STRATEGIES[strategy]
+
+    # Discovery runs serially before any worker has work (sized_tasks
+    # stats and sorts every file before its first batch), so it is timed
+    # on its own and kept out of the workers' utilisation figures.
+    start = time.perf_counter()
+    tasks = list(make_tasks(data_dir, jobs))
+    discovery = time.perf_counter() - start
 
-def count_keywords(data_dir):
     counter = Counter()
-    with ProcessPoolExecutor(max_workers=8) as executor:
-        for status, result in enumerate(
-            executor.map(process_project, data_dir.iterdir())
+    busy = defaultdict(float)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for status, (pid, elapsed, result) in enumerate(
+            imap_unordered(
+                executor,
+                partial(_timed, partial(process, cache=cache, mode=mode)),
+                tasks,
+            )
         ):
             if status % 10 == 0:
-                print(f"{status} projects processed.")
+                print(f"{status} tasks processed.")
+            busy[pid] += elapsed
             counter.update(result)
 
+    wall = time.perf_counter() - start
+    print(f"{len(tasks)} tasks discovered in {discovery:.2f}s.")
+    print(f"{jobs} workers, {wall:.2f}s wall time.")
+    for pid, seconds in sorted(busy.items()):
+        print(f"worker {pid}: {seconds:.2f}s busy ({seconds / wall:.0%})")
     return counter
 
 
 def main(args=None):
     parser = ArgumentParser()
     parser.add_argument("data_dir", type=Path)
+    parser.add_argument(
+        "--cache", type=ResultCache, help="directory for cached results"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, help="worker processes (default: CPUs)"
+    )
+    parser.add_argument(
+        "--strategy",
+        choices=sorted(STRATEGIES),
+        default="sized",
+        help="one task per project, or size-balanced file batches",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=list(MODES),
+        default="parse",
+        help="validate with ast.parse, tokenize only, or regex scan",
+    )
 
     options = parser.parse_args(args)
-    pprint(count_keywords(options.data_dir))
+    pprint(
+        count_keywords(
+            options.data_dir,
+            options.cache,
+            options.jobs,
+            options.strategy,
+            options.mode,
+        )
+    )
 
 
 if __name__ == "__main__":
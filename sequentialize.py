@@ -2,10 +2,40 @@
 # bytecode vs tree walking interpreters to my friend.
 
 import ast
+import gc
+import hashlib
 import io
+import marshal
+import operator
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
 import tokenize
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from array import array
 from dataclasses import dataclass
-from typing import Iterator, List, Optional, Union
+from functools import lru_cache, partial
+from pprint import pprint
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Union,
+)
+
+
+# Source files are always UTF-8, whatever the locale says.
+ENCODING = "utf-8"
 
 
 def lex(source: str) -> Iterator[tokenize.TokenInfo]:
@@ -13,6 +43,11 @@ def lex(source: str) -> Iterator[tokenize.TokenInfo]:
     yield from tokenize.generate_tokens(buffer.readline)
 
 
+def lex_stream(stream: TextIO) -> Iterator[tokenize.TokenInfo]:
+    # Reads the program line by line, so it never has to fit in memory.
+    yield from tokenize.generate_tokens(stream.readline)
+
+
 class Node:
     ...
 
@@ -42,49 +77,53 @@ class Program(Node):
     blocks: List[Node]
 
 
-def parse(source: str) -> Program:
-    tokens = lex(source)
+IGNORED = frozenset(
+    {tokenize.NEWLINE, tokenize.NL, tokenize.COMMENT, tokenize.ENDMARKER}
+)
 
-    def parse_expr(tokens, lookahead):
-        if lookahead.exact_type in (tokenize.STRING, tokenize.NUMBER):
-            value = ast.literal_eval(lookahead.string)
+
+def parse_atom(lookahead: tokenize.TokenInfo) -> Optional[Node]:
+    if lookahead.exact_type in (tokenize.STRING, tokenize.NUMBER):
+        value = ast.literal_eval(lookahead.string)
+        return Constant(value)
+    elif lookahead.exact_type == tokenize.NAME:
+        if lookahead.string in ("true", "false"):
+            value = ast.literal_eval(lookahead.string.title())
             return Constant(value)
-        elif lookahead.exact_type == tokenize.NAME:
-            if lookahead.string in ("true", "false"):
-                value = ast.literal_eval(lookahead.string.title())
-                return Constant(value)
-            else:
-                return Identifier(lookahead.string)
-        elif lookahead.exact_type == tokenize.LSQB:
-            nodes = []
-            while True:
-                lookahead = next(tokens)
-                if lookahead.exact_type == tokenize.RSQB:
-                    break
-                if node := parse_expr(tokens, lookahead):
-                    nodes.append(node)
-            return Sequence(nodes)
-        elif lookahead.type == tokenize.OP:
-            return Operation(lookahead.string)
-        elif lookahead.type in (
-            tokenize.NEWLINE,
-            tokenize.NL,
-            tokenize.COMMENT,
-            tokenize.ENDMARKER,
-        ):
-            return None
         else:
-            raise SyntaxError(f"Unexpected token: {token.string!r}")
+            return Identifier(lookahead.string)
+    elif lookahead.exact_type in (tokenize.LSQB, tokenize.RSQB):
+        raise SyntaxError(f"Unexpected token: {lookahead.string!r}")
+    elif lookahead.type == tokenize.OP:
+        return Operation(lookahead.string)
+    elif lookahead.type in IGNORED:
+        return None
+    else:
+        raise SyntaxError(f"Unexpected token: {lookahead.string!r}")
+
 
-    nodes = []
-    while True:
-        try:
-            if node := parse_expr(tokens, next(tokens)):
+def parse_expr(
+    tokens: Iterator[tokenize.TokenInfo], lookahead: tokenize.TokenInfo
+) -> Optional[Node]:
+    if lookahead.exact_type == tokenize.LSQB:
+        nodes = []
+        for lookahead in tokens:
+            if lookahead.exact_type == tokenize.RSQB:
+                return Sequence(nodes)
+            if node := parse_expr(tokens, lookahead):
                 nodes.append(node)
-        except StopIteration:
-            break
+        raise SyntaxError("Unterminated sequence")
+    return parse_atom(lookahead)
 
-    return Program(nodes)
+
+def parse_blocks(tokens: Iterator[tokenize.TokenInfo]) -> Iterator[Node]:
+    for lookahead in tokens:
+        if node := parse_expr(tokens, lookahead):
+            yield node
+
+
+def parse(source: str) -> Program:
+    return Program(list(parse_blocks(lex(source))))
 
 
 @dataclass
@@ -98,24 +137,792 @@ class Bytecode:
     instructions: List[Instruction]
 
 
+OPCODES = (
+    "LOAD_LIT",
+    "CALL_SYM",
+    "CALL_FUN",
+    "BUILD_STACK",
+    # Superinstructions, only emitted by the optimizer.
+    "LOAD_LIT2",
+    "CALL_FUN_LIT",
+    "DROP_N",
+)
+OPCODE_INDEX = {opcode: index for index, opcode in enumerate(OPCODES)}
+
+# Counts (BUILD_STACK, DROP_N) are stored inline; all the other opargs
+# are stored as an index into the pool.
+POOLED = frozenset(
+    {"LOAD_LIT", "CALL_SYM", "CALL_FUN", "LOAD_LIT2", "CALL_FUN_LIT"}
+)
+
+
+@dataclass
+class PackedBytecode:
+    """Bytecode as parallel arrays: one byte per opcode, one int per
+    operand, and a pool holding each distinct literal or word once.
+    Roughly 5 bytes per instruction instead of ~100 for an Instruction
+    and its __dict__."""
+
+    opcodes: array
+    operands: array
+    pool: list
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+
+def _pool_key(value):
+    # 1 == 1.0 == True, so the type is part of the key, all the way down;
+    # and 0.0 == -0.0, so floats are keyed by their exact bits.
+    if isinstance(value, tuple):
+        return tuple, tuple(map(_pool_key, value))
+    if isinstance(value, float):
+        return float, value.hex()
+    return type(value), value
+
+
+def same_bytecode(left: Bytecode, right: Bytecode) -> bool:
+    # Dataclass equality has the same blind spots as a plain dict key
+    # (1 == True, 0.0 == -0.0); the reprs keep every type and sign.
+    return repr(left) == repr(right)
+
+
+def pack(bytecode: Bytecode) -> PackedBytecode:
+    opcodes, operands, pool = array("B"), array("i"), []
+    indices = {}
+    for instruction in bytecode.instructions:
+        oparg = instruction.oparg
+        if instruction.opcode in POOLED:
+            key = _pool_key(oparg)
+            if key not in indices:
+                indices[key] = len(pool)
+                pool.append(oparg)
+            oparg = indices[key]
+        opcodes.append(OPCODE_INDEX[instruction.opcode])
+        operands.append(oparg)
+    return PackedBytecode(opcodes, operands, pool)
+
+
+def unpack(packed: PackedBytecode) -> Bytecode:
+    instructions = []
+    for opcode, operand in zip(packed.opcodes, packed.operands):
+        opcode = OPCODES[opcode]
+        if opcode in POOLED:
+            operand = packed.pool[operand]
+        instructions.append(Instruction(opcode, operand))
+    return Bytecode(instructions)
+
+
+def compile_node(node: Node) -> Iterator[Instruction]:
+    if isinstance(node, Constant):
+        yield Instruction("LOAD_LIT", node.value)
+    elif isinstance(node, Identifier):
+        yield Instruction("CALL_SYM", node.name)
+    elif isinstance(node, Operation):
+        yield Instruction("CALL_FUN", node.kind)
+    elif isinstance(node, Sequence):
+        for elt in node.elements:
+            yield from compile_node(elt)
+        yield Instruction("BUILD_STACK", len(node.elements))
+
+
+def compile_tokens(
+    tokens: Iterator[tokenize.TokenInfo],
+) -> Iterator[Instruction]:
+    """Compile straight from the token stream, one instruction at a
+    time. Only atoms are ever built; a sequence is tracked as a count of
+    its elements until its closing bracket emits the BUILD_STACK, so
+    memory is bounded by the nesting depth, not the program size."""
+    counts = []
+    for lookahead in tokens:
+        if lookahead.exact_type == tokenize.LSQB:
+            counts.append(0)
+            continue
+        elif lookahead.exact_type == tokenize.RSQB:
+            if not counts:
+                raise SyntaxError("Unexpected token: ']'")
+            yield Instruction("BUILD_STACK", counts.pop())
+        elif node := parse_atom(lookahead):
+            yield from compile_node(node)
+        else:
+            continue
+        if counts:
+            counts[-1] += 1
+    if counts:
+        raise SyntaxError("Unterminated sequence")
+
+
 def compile_j(source: str) -> Bytecode:
-    def compile_node(node):
+    return Bytecode(list(compile_tokens(lex(source))))
+
+
+# Both evaluators share the same primitives, which operate on the value
+# stack in place. Operations are the operator tokens (CALL_FUN) and
+# symbols are the named words (CALL_SYM).
+
+
+def _binary(function):
+    def operation(stack):
+        right = stack.pop()
+        stack.append(function(stack.pop(), right))
+
+    return operation
+
+
+def _dup(stack):
+    stack.append(stack[-1])
+
+
+def _swap(stack):
+    stack[-1], stack[-2] = stack[-2], stack[-1]
+
+
+def _drop(stack):
+    stack.pop()
+
+
+def _over(stack):
+    stack.append(stack[-2])
+
+
+# Every operation is a pure binary function, which is what lets the
+# optimizer fold them over literals.
+BINARY = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": operator.truediv,
+    "%": operator.mod,
+    "==": operator.eq,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+
+OPERATIONS = {kind: _binary(function) for kind, function in BINARY.items()}
+
+SYMBOLS = {
+    "dup": _dup,
+    "swap": _swap,
+    "drop": _drop,
+    "over": _over,
+}
+
+
+def lookup(table, name):
+    try:
+        return table[name]
+    except KeyError:
+        raise NameError(f"Unknown word: {name!r}") from None
+
+
+def build_stack(stack, count):
+    # A sequence packs the values its elements left behind into a list,
+    # so every element of a sequence is expected to leave exactly one.
+    if count > len(stack):
+        raise RuntimeError(f"Stack underflow: need {count} values")
+    values = stack[len(stack) - count :]
+    del stack[len(stack) - count :]
+    stack.append(values)
+
+
+def drop_n(stack, count):
+    # Fails exactly as `count` separate drops would, so fusing them
+    # never changes a program's behaviour on underflow.
+    if count > len(stack):
+        stack.clear()
+        raise IndexError("pop from empty list")
+    del stack[len(stack) - count :]
+
+
+def _apply_literal(stack, function, value):
+    stack.append(function(stack.pop(), value))
+
+
+def evaluate(program: Program, stack: Optional[list] = None) -> list:
+    """Evaluate the tree directly, re-dispatching on node types (and
+    looking up every word) each time a node is visited."""
+    if stack is None:
+        stack = []
+
+    def evaluate_node(node):
         if isinstance(node, Constant):
-            yield Instruction("LOAD_LIT", node.value)
+            stack.append(node.value)
         elif isinstance(node, Identifier):
-            yield Instruction("CALL_SYM", node.name)
+            lookup(SYMBOLS, node.name)(stack)
         elif isinstance(node, Operation):
-            yield Instruction("CALL_FUN", node.kind)
+            lookup(OPERATIONS, node.kind)(stack)
         elif isinstance(node, Sequence):
-            for elt in node.elements:
-                yield from compile_node(elt)
-            yield Instruction("BUILD_STACK", len(node.elements))
+            for element in node.elements:
+                evaluate_node(element)
+            build_stack(stack, len(node.elements))
 
-    program = parse(source)
-    instructions = []
     for node in program.blocks:
-        instructions.extend(compile_node(node))
+        evaluate_node(node)
+    return stack
+
+
+# opcode -> linker, which binds the instruction's oparg and the VM's
+# stack into a call that takes no arguments.
+DISPATCH = {
+    "LOAD_LIT": lambda stack, value: partial(stack.append, value),
+    "CALL_SYM": lambda stack, name: partial(lookup(SYMBOLS, name), stack),
+    "CALL_FUN": lambda stack, kind: partial(lookup(OPERATIONS, kind), stack),
+    "BUILD_STACK": lambda stack, count: partial(build_stack, stack, count),
+    "LOAD_LIT2": lambda stack, values: partial(stack.extend, values),
+    "CALL_FUN_LIT": lambda stack, oparg: partial(
+        _apply_literal, stack, lookup(BINARY, oparg[0]), oparg[1]
+    ),
+    "DROP_N": lambda stack, count: partial(drop_n, stack, count),
+}
+
+
+class VM:
+    """Stack machine for compiled bytecode. Every instruction is linked
+    once, on load, through the dispatch table; running the program is
+    then a flat loop of calls with no decoding or lookups left in it.
+
+    Packed bytecode links each distinct (opcode, operand) pair only once
+    and shares the call between its uses, so the linked program costs a
+    pointer per instruction."""
+
+    def __init__(self, bytecode: Union[Bytecode, PackedBytecode]) -> None:
+        self.stack: list = []
+        if isinstance(bytecode, PackedBytecode):
+            self.code = self.link_packed(bytecode)
+        else:
+            self.code = [
+                DISPATCH[instruction.opcode](self.stack, instruction.oparg)
+                for instruction in bytecode.instructions
+            ]
+
+    def link_packed(
+        self, packed: PackedBytecode
+    ) -> List[Callable[[], Any]]:
+        code, linked = [], {}
+        for key in zip(packed.opcodes, packed.operands):
+            instruction = linked.get(key)
+            if instruction is None:
+                opcode, operand = OPCODES[key[0]], key[1]
+                if opcode in POOLED:
+                    operand = packed.pool[operand]
+                instruction = DISPATCH[opcode](self.stack, operand)
+                linked[key] = instruction
+            code.append(instruction)
+        return code
+
+    def run(self) -> list:
+        self.stack.clear()
+        for instruction in self.code:
+            instruction()
+        return list(self.stack)
+
+
+def execute(bytecode: Union[Bytecode, PackedBytecode]) -> list:
+    return VM(bytecode).run()
+
+
+def execute_stream(instructions: Iterable[Instruction]) -> list:
+    """Run instructions as they arrive, linking each one on the fly,
+    for programs that are never held in memory as a whole."""
+    stack = []
+    for instruction in instructions:
+        DISPATCH[instruction.opcode](stack, instruction.oparg)()
+    return stack
+
+
+# A bytecode file is the magic followed by (opcode, operand) records.
+# A pooled value is written, marshalled, the first time it is used, as
+# a POOL_ENTRY record whose operand is its size; later uses refer to it
+# by its index, just like PackedBytecode. An END record carrying the
+# instruction count closes the file, so a cut-short file is detected.
+# Both directions stream.
+MAGIC = b"SEQB\x02"
+RECORD = struct.Struct("<Bi")
+POOL_ENTRY = 0xFF
+END = 0xFE
+
+
+def dump(instructions: Iterable[Instruction], stream: BinaryIO) -> int:
+    stream.write(MAGIC)
+    indices = {}
+    count = 0
+    for instruction in instructions:
+        oparg = instruction.oparg
+        if instruction.opcode in POOLED:
+            key = _pool_key(oparg)
+            if key not in indices:
+                indices[key] = len(indices)
+                data = marshal.dumps(oparg)
+                stream.write(RECORD.pack(POOL_ENTRY, len(data)))
+                stream.write(data)
+            oparg = indices[key]
+        stream.write(RECORD.pack(OPCODE_INDEX[instruction.opcode], oparg))
+        count += 1
+    stream.write(RECORD.pack(END, count))
+    return count
+
+
+def load(stream: BinaryIO) -> Iterator[Instruction]:
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a bytecode file")
+    pool = []
+    count = 0
+    while len(record := stream.read(RECORD.size)) == RECORD.size:
+        opcode, operand = RECORD.unpack(record)
+        if opcode == END:
+            if operand != count or stream.read(1):
+                raise ValueError("Corrupt bytecode file")
+            return
+        elif opcode == POOL_ENTRY:
+            pool.append(marshal.loads(stream.read(operand)))
+            continue
+        opcode = OPCODES[opcode]
+        if opcode in POOLED:
+            operand = pool[operand]
+        yield Instruction(opcode, operand)
+        count += 1
+    raise ValueError("Truncated bytecode file")
+
+
+@contextmanager
+def atomic_output(path: str) -> Iterator[BinaryIO]:
+    """Write a file through a temporary next to it, replacing path only
+    once the whole file is written; on failure nothing is left behind."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(fd, "wb") as stream:
+            yield stream
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# A cache file is the header, then every opcode, every operand (int32,
+# little-endian) and the marshalled pool, so loading it is one read and
+# a few slices of a memoryview.
+CACHE_HEADER = struct.Struct("<5s32sI")
+CACHE_MAGIC = b"SEQC\x01"
+
+
+@lru_cache(maxsize=None)
+def _compiler_digest() -> bytes:
+    # Editing the compiler or the opcode table invalidates every cache.
+    with open(__file__, "rb") as stream:
+        return hashlib.sha256(stream.read()).digest()
+
+
+def source_digest(source: bytes, passes=()) -> bytes:
+    # optimize() runs passes in PASSES order whatever order they are
+    # given in, so the key must not depend on it (or on repeats).
+    passes = [name for name in PASSES if name in passes]
+    digest = hashlib.sha256(_compiler_digest())
+    digest.update("\0".join(passes).encode())
+    digest.update(b"\0")
+    digest.update(source)
+    return digest.digest()
+
+
+def cache_path(path: str) -> str:
+    return path + "c"
+
+
+def dumps_packed(packed: PackedBytecode, digest: bytes) -> bytes:
+    operands = packed.operands
+    if sys.byteorder == "big":
+        operands = array("i", operands)
+        operands.byteswap()
+    return b"".join(
+        (
+            CACHE_HEADER.pack(CACHE_MAGIC, digest, len(packed)),
+            packed.opcodes.tobytes(),
+            operands.tobytes(),
+            marshal.dumps(packed.pool),
+        )
+    )
+
+
+def loads_packed(data: bytes, digest: bytes) -> Optional[PackedBytecode]:
+    """Parse a cache file, or return None if it is stale or damaged."""
+    view = memoryview(data)
+    if len(view) < CACHE_HEADER.size:
+        return None
+    magic, stored, count = CACHE_HEADER.unpack_from(view)
+    if magic != CACHE_MAGIC or stored != digest:
+        return None
+
+    start = CACHE_HEADER.size
+    middle = start + count
+    end = middle + count * 4
+    if len(view) < end:
+        return None
+    opcodes, operands = array("B"), array("i")
+    opcodes.frombytes(view[start:middle])
+    operands.frombytes(view[middle:end])
+    if sys.byteorder == "big":
+        operands.byteswap()
+    try:
+        pool = marshal.loads(view[end:])
+    except (EOFError, ValueError, TypeError):
+        return None
+    return PackedBytecode(opcodes, operands, pool)
+
+
+def compile_cached(path: str, passes=()) -> PackedBytecode:
+    """Compile a source file, reusing the cache next to it when the
+    source (and the compiler) haven't changed since it was written."""
+    with open(path, "rb") as stream:
+        source = stream.read()
+    digest = source_digest(source, passes)
+    cached = cache_path(path)
+    try:
+        with open(cached, "rb") as stream:
+            packed = loads_packed(stream.read(), digest)
+    except OSError:
+        packed = None
+    if packed is not None:
+        return packed
+
+    packed = pack(optimize(compile_j(source.decode(ENCODING)), passes))
+    try:
+        with atomic_output(cached) as stream:
+            stream.write(dumps_packed(packed, digest))
+    except OSError:
+        # Like a .pyc, the cache is only an optimization.
+        pass
+    return packed
+
+
+# Folding never produces a sequence or string longer than this, so a
+# short program can't turn into a huge constant.
+MAX_FOLDED_SIZE = 4096
+
+SIZED = (str, bytes)
+
+
+def folded_size(kind: str, left: Any, right: Any) -> float:
+    """Size of the value folding would build, worked out from the
+    operands so an oversized result is never computed."""
+    if kind == "+" and isinstance(left, SIZED) and isinstance(right, SIZED):
+        return len(left) + len(right)
+    if kind == "*":
+        for sequence, count in ((left, right), (right, left)):
+            if isinstance(sequence, SIZED) and isinstance(count, int):
+                return len(sequence) * max(count, 0)
+    if kind == "%" and isinstance(left, SIZED):
+        # printf-style formatting ('%1000000000d') can be any size.
+        return float("inf")
+    return 0
+
+
+def fold_constants(instructions: List[Instruction]) -> List[Instruction]:
+    """Replace an operation applied to two literals with its result.
+    Operations that fail (e.g. on a division by zero) or whose result
+    would exceed MAX_FOLDED_SIZE are left alone to run at run time."""
+    folded = []
+    for instruction in instructions:
+        if (
+            instruction.opcode == "CALL_FUN"
+            and instruction.oparg in BINARY
+            and len(folded) >= 2
+            and folded[-1].opcode == folded[-2].opcode == "LOAD_LIT"
+        ):
+            left, right = folded[-2].oparg, folded[-1].oparg
+            if folded_size(instruction.oparg, left, right) <= MAX_FOLDED_SIZE:
+                try:
+                    value = BINARY[instruction.oparg](left, right)
+                except Exception:
+                    pass
+                else:
+                    del folded[-2:]
+                    folded.append(Instruction("LOAD_LIT", value))
+                    continue
+        folded.append(instruction)
+    return folded
+
+
+def eliminate_dead_pushes(
+    instructions: List[Instruction],
+) -> List[Instruction]:
+    """Drop literals and empty sequences that are dropped right after
+    being pushed. Neither can fail, so removing them is always safe."""
+    kept = []
+    for instruction in instructions:
+        if (
+            instruction.opcode == "CALL_SYM"
+            and instruction.oparg == "drop"
+            and kept
+            and (
+                kept[-1].opcode == "LOAD_LIT"
+                or kept[-1].opcode == "BUILD_STACK"
+                and kept[-1].oparg == 0
+            )
+        ):
+            kept.pop()
+            continue
+        kept.append(instruction)
+    return kept
+
+
+def fuse_superinstructions(
+    instructions: List[Instruction],
+) -> List[Instruction]:
+    """Merge the most common pairs into one instruction: a literal used
+    as an operation's right operand, two literals in a row, and runs of
+    drops."""
+    fused = []
+    index = 0
+    while index < len(instructions):
+        instruction = instructions[index]
+        following = instructions[index + 1 : index + 2]
+        if instruction.opcode == "LOAD_LIT" and following:
+            (following,) = following
+            if following.opcode == "CALL_FUN" and following.oparg in BINARY:
+                fused.append(
+                    Instruction(
+                        "CALL_FUN_LIT", (following.oparg, instruction.oparg)
+                    )
+                )
+                index += 2
+                continue
+            # Leave the second literal to pair with an operation.
+            pairs_with_next = (
+                index + 2 < len(instructions)
+                and instructions[index + 2].opcode == "CALL_FUN"
+            )
+            if following.opcode == "LOAD_LIT" and not pairs_with_next:
+                fused.append(
+                    Instruction(
+                        "LOAD_LIT2", (instruction.oparg, following.oparg)
+                    )
+                )
+                index += 2
+                continue
+        elif instruction.opcode == "CALL_SYM" and instruction.oparg == "drop":
+            count = 1
+            while (
+                index + count < len(instructions)
+                and instructions[index + count] == instruction
+            ):
+                count += 1
+            if count > 1:
+                fused.append(Instruction("DROP_N", count))
+                index += count
+                continue
+        fused.append(instruction)
+        index += 1
+    return fused
+
+
+# Passes in the order they run; folding first exposes dead literals and
+# both of them run before fusing hides the patterns they look for.
+PASSES = {
+    "fold": fold_constants,
+    "dead": eliminate_dead_pushes,
+    "fuse": fuse_superinstructions,
+}
+
+
+def optimize(bytecode: Bytecode, passes=tuple(PASSES)) -> Bytecode:
+    instructions = bytecode.instructions
+    for name, function in PASSES.items():
+        if name in passes:
+            instructions = function(instructions)
     return Bytecode(instructions)
 
 
-print(compile_j("[1 2 + * [dup] [] + + ] * * +"))
+def generate_program(size: int, seed: int = 0) -> str:
+    """Generate a well-formed program of roughly `size` instructions,
+    tracking the type of each stack slot so every word applies."""
+    rng = random.Random(seed)
+
+    def sequence(depth):
+        elements = []
+        for _ in range(rng.randint(0, 4)):
+            if depth < 3 and rng.random() < 0.3:
+                elements.append(sequence(depth + 1))
+            else:
+                elements.append(str(rng.randint(0, 99)))
+        return "[" + " ".join(elements) + "]"
+
+    # Each slot is the bound on a number's magnitude, or None for a
+    # list. Lists are never concatenated and numbers are reduced once
+    # they grow, so a long run of dups can't blow up the values.
+    words, slots = [], []
+    count = 0
+    while count < size:
+        choices = ["literal", "sequence"]
+        if slots:
+            choices += ["dup", "drop"]
+        if len(slots) >= 2:
+            choices += ["swap", "over"]
+            if slots[-1] is not None and slots[-2] is not None:
+                choices += ["+", "-"] * 2
+        if len(slots) > 8:
+            choices = [choice for choice in choices if choice != "literal"]
+            choices += ["drop"] * 2
+        if slots and slots[-1] is not None and slots[-1] > 10**6:
+            choices = ["reduce"]
+
+        choice = rng.choice(choices)
+        if choice == "literal":
+            words.append(str(rng.randint(0, 99)))
+            slots.append(99)
+        elif choice == "sequence":
+            words.append(sequence(0))
+            slots.append(None)
+            count += words[-1].count("[") + len(words[-1].split()) - 1
+        elif choice == "reduce":
+            words.append("97 %")
+            slots[-1] = 96
+            count += 1
+        else:
+            words.append(choice)
+            if choice == "dup":
+                slots.append(slots[-1])
+            elif choice == "over":
+                slots.append(slots[-2])
+            elif choice == "swap":
+                slots[-1], slots[-2] = slots[-2], slots[-1]
+            elif choice in ("+", "-"):
+                slots.append(slots.pop() + slots.pop())
+            else:
+                slots.pop()
+        count += 1
+    return " ".join(words)
+
+
+def _allocated(build):
+    # Memory still held by whatever build() returns.
+    tracemalloc.start()
+    try:
+        result = build()
+        return result, tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+
+def _best_of(run, repeat):
+    # Like timeit, keep the collector out of the measurement; it scales
+    # with the size of the heap, not with the program being run.
+    best = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            best = min(best, time.perf_counter() - start)
+    finally:
+        gc.enable()
+    return best
+
+
+def benchmark(
+    sizes=(1_000, 10_000, 100_000, 1_000_000), repeat=3, passes=None
+):
+    passes = tuple(PASSES) if passes is None else passes
+    for size in sizes:
+        source = generate_program(size)
+        program = parse(source)
+        packed = pack(compile_j(source))
+        bytecode, unpacked_size = _allocated(partial(unpack, packed))
+        _, packed_size = _allocated(partial(pack, bytecode))
+        assert same_bytecode(unpack(packed), bytecode)
+        print(
+            f"{len(packed)} instructions: "
+            f"{unpacked_size / len(packed):.0f} bytes/instruction unpacked, "
+            f"{packed_size / len(packed):.1f} packed"
+        )
+
+        vm, packed_vm = VM(bytecode), VM(packed)
+        assert evaluate(program) == vm.run() == packed_vm.run()
+
+        timings = []
+        runs = (
+            ("tree", partial(evaluate, program)),
+            ("vm", vm.run),
+            ("packed vm", packed_vm.run),
+        )
+        for name, run in runs:
+            best = _best_of(run, repeat)
+            rate = len(bytecode.instructions) / best
+            timings.append(f"{name} {best * 1000:.1f}ms ({rate:,.0f} ins/s)")
+        print("   ", ", ".join(timings))
+
+        optimized = optimize(bytecode, passes)
+        optimized_vm = VM(pack(optimized))
+        assert same_bytecode(unpack(pack(optimized)), optimized)
+        assert optimized_vm.run() == vm.run()
+        print(
+            f"    optimized ({', '.join(passes) or 'no passes'}):",
+            f"{len(optimized.instructions)} instructions,",
+            f"packed vm {_best_of(optimized_vm.run, repeat) * 1000:.1f}ms",
+        )
+
+
+def stream_file(path, output=None):
+    # Streams never go through the optimizer; its passes want the whole
+    # instruction list.
+    with open(path, encoding=ENCODING) as stream:
+        instructions = compile_tokens(lex_stream(stream))
+        if output is None:
+            return print(execute_stream(instructions))
+        with atomic_output(output) as sink:
+            count = dump(instructions, sink)
+        print(f"{count} instructions written.")
+
+
+def main(args=None):
+    parser = ArgumentParser()
+    parser.add_argument("source", nargs="?", help="program to run")
+    parser.add_argument(
+        "-f", "--file", help="stream the program from a source file"
+    )
+    parser.add_argument(
+        "-b", "--bytecode", help="stream the program from a bytecode file"
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="with --file, compile through the bytecode cache next to it",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="with --file, write the bytecode here instead of running it",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="time both evaluators on generated programs",
+    )
+    parser.add_argument(
+        "-O",
+        "--optimize",
+        action="append",
+        choices=list(PASSES),
+        help="optimizer pass to run (repeatable; default: none, or all "
+        "of them for --benchmark)",
+    )
+
+    options = parser.parse_args(args)
+    if options.benchmark:
+        return benchmark(passes=options.optimize)
+    if options.file is not None and options.cache:
+        packed = compile_cached(options.file, options.optimize or ())
+        return print(execute(packed))
+    if options.file is not None:
+        return stream_file(options.file, options.output)
+    if options.bytecode is not None:
+        with open(options.bytecode, "rb") as stream:
+            return print(execute_stream(load(stream)))
+    if options.source is None:
+        parser.error("a program is required")
+
+    bytecode = optimize(compile_j(options.source), options.optimize or ())
+    pprint(bytecode.instructions)
+    print(execute(bytecode))
+
+
+if __name__ == "__main__":
+    main()